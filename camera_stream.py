@@ -1,19 +1,38 @@
 import cv2
 import asyncio
-import json
 import logging
+import threading
+import time
+import numpy as np
+import orjson
 from aiohttp import web
 from av import VideoFrame
 from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamError
 from fractions import Fraction
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)  # Cambiado a INFO para reducir logs
 logger = logging.getLogger(__name__)
 
+# Limitar los hilos de OpenCV para no competir con aiortc por los núcleos
+cv2.setNumThreads(2)
+cv2.setUseOptimized(True)
+
 # Set para mantener las conexiones activas
 pcs = set()
 
+# Lecturas fallidas seguidas (~3 s) tras las que se da la cámara por perdida
+MAX_READ_FAILURES = 30
+
+def plane_view(video_frame):
+    # Vista numpy (alto, ancho, 3) sobre el plano de un VideoFrame empaquetado
+    # (rgb24/bgr24), respetando el padding de cada fila
+    plane = video_frame.planes[0]
+    return np.ndarray((video_frame.height, video_frame.width, 3), dtype=np.uint8,
+                      buffer=plane, strides=(plane.line_size, 3, 1))
+
 class VideoTransformTrack(MediaStreamTrack):
     kind = "video"
 
@@ -24,39 +43,159 @@ class VideoTransformTrack(MediaStreamTrack):
         self.cap = cv2.VideoCapture(0)
         
         # Configurar la cámara
+        # Pedir MJPEG al driver en lugar del YUYV por defecto
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
         self.cap.set(cv2.CAP_PROP_FPS, 30)
+        # Mantener solo el frame más reciente en el buffer del driver
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
         
         if not self.cap.isOpened():
             raise RuntimeError("No se pudo abrir la cámara")
+        
+        # retrieve() escribe directo en el plano de un VideoFrame nuevo por
+        # frame, que nunca se reutiliza: cada peer puede seguir codificándolo
+        # sin que el hilo lo pise
+        self._height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self._width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             
-        # Configurar el tiempo base para los frames
-        self.time_base = Fraction(1, 30)  # 30 FPS
+        # Reloj RTP de video (90 kHz), el mismo que usa aiortc internamente:
+        # así el encoder no tiene que reescalar el pts con Fraction
+        self._clock_rate = 90000
+        self.time_base = Fraction(1, self._clock_rate)
         self.pts = 0
+        self._start_time = None
         
-    async def recv(self):
-        ret, frame = self.cap.read()
+        # Captura (y procesamiento) en un hilo aparte para no bloquear el
+        # event loop; solo se guarda el frame más reciente
+        self._latest = None  # último VideoFrame, pendiente para recv
+        self._frame_ready = threading.Event()
+        # Protege _latest y el evento, para que el evento nunca quede
+        # activo sin un frame pendiente
+        self._frames_lock = threading.Lock()
+        self._running = True
+        # Loop de asyncio, para terminar el track desde el hilo de captura
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.Thread(target=self._capture_loop, daemon=True)
+        self._thread.start()
         
-        if not ret:
-            logger.error("Error al leer frame")
-            return None
+    def _capture_loop(self):
+        try:
+            self._capture_frames()
+        except Exception:
+            logger.exception("Error en el hilo de captura")
+        finally:
+            # El hilo es el único que usa la cámara: liberarla al terminar
+            self.cap.release()
+            # Si el hilo terminó por su cuenta (error o cámara perdida),
+            # terminar el track para que recv falle y el relay se cierre
+            if self._running:
+                self._running = False
+                self._loop.call_soon_threadsafe(self.stop)
+
+    def _capture_frames(self):
+        failures = 0
+        while self._running:
+            # grab() sin decodificar y retrieve() solo del frame que se envía
+            ret = self.cap.grab()
+            if ret:
+                video_frame = VideoFrame(self._width, self._height, "bgr24")
+                view = plane_view(video_frame)
+                ret, frame = self.cap.retrieve(view)
             
-        # Convertir frame para WebRTC
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        video_frame = VideoFrame.from_ndarray(frame, format="rgb24")
+            if not ret:
+                failures += 1
+                if failures >= MAX_READ_FAILURES:
+                    logger.error("La cámara dejó de entregar frames")
+                    return
+                logger.error("Error al leer frame")
+                time.sleep(0.1)
+                continue
+            failures = 0
+            
+            # Si OpenCV tuvo que reasignar el buffer, copiar al plano
+            if frame is not view:
+                np.copyto(view, frame)
+            
+            # Se envía en BGR tal cual; PyAV convierte al formato del encoder
+            self._publish(video_frame)
+
+    def _publish(self, video_frame):
+        with self._frames_lock:
+            # Un frame que recv no llegó a leer se descarta
+            self._latest = video_frame
+            self._frame_ready.set()
+
+    async def recv(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._frame_ready.wait)
+        
+        if self.readyState != "live":
+            raise MediaStreamError
+        with self._frames_lock:
+            self._frame_ready.clear()
+            video_frame = self._latest
+            self._latest = None
+        self._advance_pts()
         video_frame.pts = self.pts
         video_frame.time_base = self.time_base
-        
-        self.pts += 1
         return video_frame
 
+    def stop(self):
+        super().stop()
+        # Detener el hilo de captura y liberar a recv si está esperando
+        self._running = False
+        self._frame_ready.set()
+
+    def join(self):
+        # Esperar a que termine el hilo de captura (después de stop())
+        self._thread.join()
+
+    def _advance_pts(self):
+        # pts según el tiempo real transcurrido, para no acumular retraso
+        # cuando se descartan frames; siempre monótono creciente
+        now = time.monotonic()
+        if self._start_time is None:
+            # El primer frame marca el origen del reloj
+            self._start_time = now
+            self.pts = 0
+            return
+        elapsed = int((now - self._start_time) * self._clock_rate)
+        self.pts = max(elapsed, self.pts + 1)
+
     def __del__(self):
         if hasattr(self, 'cap') and self.cap is not None:
             self.cap.release()
 
+# Una sola cámara (y un solo pipeline) compartida entre todas las conexiones;
+# MediaRelay reparte sus frames a cada peer
+relay = MediaRelay()
+camera_track = None
+# Evita que dos offers simultáneos abran la cámara dos veces
+camera_lock = asyncio.Lock()
+
+async def subscribe_camera():
+    global camera_track
+    async with camera_lock:
+        if camera_track is None or camera_track.readyState != "live":
+            if camera_track is not None:
+                # Esperar (fuera del event loop) a que el hilo anterior suelte
+                # la cámara antes de reabrirla
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, camera_track.join)
+            camera_track = VideoTransformTrack()
+    # Sin buffer: cada peer recibe solo el frame más reciente
+    return relay.subscribe(camera_track, buffered=False)
+
+def stop_camera():
+    # Detiene el hilo de captura y libera la cámara; el próximo
+    # subscribe_camera() la vuelve a abrir
+    if camera_track is not None:
+        camera_track.stop()
+
 async def offer(request):
-    params = await request.json()
+    params = orjson.loads(await request.read())
     
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
     
@@ -65,14 +204,16 @@ async def offer(request):
     
     @pc.on("connectionstatechange")
     async def on_connectionstatechange():
-        logger.info(f"Estado de conexión WebRTC: {pc.connectionState}")
-        if pc.connectionState == "failed":
+        logger.info("Estado de conexión WebRTC: %s", pc.connectionState)
+        if pc.connectionState in ("failed", "closed"):
             await pc.close()
             pcs.discard(pc)
+            # Sin clientes no hace falta seguir capturando
+            if not pcs:
+                stop_camera()
     
     try:
-        video = VideoTransformTrack()
-        pc.addTrack(video)
+        pc.addTrack(await subscribe_camera())
         
         await pc.setRemoteDescription(offer)
         answer = await pc.createAnswer()
@@ -80,17 +221,18 @@ async def offer(request):
         
         return web.Response(
             content_type="application/json",
-            text=json.dumps({
+            body=orjson.dumps({
                 "sdp": pc.localDescription.sdp,
                 "type": pc.localDescription.type
             })
         )
     except Exception as e:
-        logger.error(f"Error en el proceso de offer: {str(e)}")
+        logger.error("Error en el proceso de offer: %s", e)
+        await pc.close()
         return web.Response(status=500, text=str(e))
 
-async def index(request):
-    content = """
+# HTML estático de la página, codificado una sola vez al cargar el módulo
+INDEX_HTML = """
     <html>
     <head>
         <title>Stream de Cámara</title>
@@ -229,14 +371,37 @@ async def index(request):
     </body>
     </html>
     """
-    return web.Response(content_type="text/html", text=content)
+_INDEX_BYTES = INDEX_HTML.encode("utf-8")
+
+async def index(request):
+    return web.Response(
+        body=_INDEX_BYTES,
+        content_type="text/html",
+        charset="utf-8",
+        headers={"Cache-Control": "public, max-age=3600"}
+    )
 
 # Crear la aplicación
 app = web.Application()
 app.router.add_get("/", index)
 app.router.add_post("/offer", offer)
 
+async def on_shutdown(app):
+    # Cerrar las conexiones y liberar la cámara al detener el servidor
+    await asyncio.gather(*[pc.close() for pc in pcs])
+    pcs.clear()
+    stop_camera()
+
+app.on_shutdown.append(on_shutdown)
+
 if __name__ == "__main__":
+    # uvloop (si está disponible) baja el costo de cada await en el event loop
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop no disponible, usando el event loop de asyncio")
+    
     try:
         print("\n=== Servidor de streaming iniciado ===")
         print("Accede a http://localhost:8080 en tu navegador")
@@ -244,6 +409,3 @@ if __name__ == "__main__":
         web.run_app(app, host="0.0.0.0", port=8080, access_log=None)  # access_log=None para reducir logs
     except KeyboardInterrupt:
         print("\nServidor detenido por el usuario")
-    finally:
-        for pc in pcs:
-            pc.close()
\ No newline at end of file
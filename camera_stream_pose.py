@@ -1,21 +1,116 @@
 import cv2
 import asyncio
-import json
 import logging
+import threading
+import time
 import mediapipe as mp
 import numpy as np
+import orjson
+from numba import njit
 from aiohttp import web
 from av import VideoFrame
 from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamError
 from fractions import Fraction
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Limitar los hilos de OpenCV para dejar núcleos libres a MediaPipe (XNNPACK)
+cv2.setNumThreads(2)
+cv2.setUseOptimized(True)
+
 # Set para mantener las conexiones activas
 pcs = set()
 
+# Mismo umbral que usa mp_drawing para ocultar landmarks poco visibles
+VISIBILITY_THRESHOLD = 0.5
+
+@njit(cache=True)
+def _stamp(frame, x, y, radius, color):
+    # Pintar un disco de radio `radius` centrado en (x, y), recortado al frame
+    h, w = frame.shape[0], frame.shape[1]
+    for dy in range(-radius, radius + 1):
+        yy = y + dy
+        if yy < 0 or yy >= h:
+            continue
+        for dx in range(-radius, radius + 1):
+            xx = x + dx
+            if xx < 0 or xx >= w or dx * dx + dy * dy > radius * radius:
+                continue
+            frame[yy, xx, 0] = color[0]
+            frame[yy, xx, 1] = color[1]
+            frame[yy, xx, 2] = color[2]
+
+@njit(cache=True)
+def _line(frame, x0, y0, x1, y1, radius, color):
+    # Bresenham, estampando un disco en cada punto para el grosor
+    dx = abs(x1 - x0)
+    dy = -abs(y1 - y0)
+    sx = 1 if x0 < x1 else -1
+    sy = 1 if y0 < y1 else -1
+    err = dx + dy
+    while True:
+        _stamp(frame, x0, y0, radius, color)
+        if x0 == x1 and y0 == y1:
+            break
+        e2 = 2 * err
+        if e2 >= dy:
+            err += dy
+            x0 += sx
+        if e2 <= dx:
+            err += dx
+            y0 += sy
+
+@njit(cache=True, fastmath=True)
+def draw_landmarks(frame, pts, conns, point_color, line_color, thickness):
+    # pts: float32[N, 3] con (x, y, visibility) normalizados a [0, 1]
+    # conns: int32[M, 2] con los índices de cada conexión
+    h, w = frame.shape[0], frame.shape[1]
+    n = pts.shape[0]
+    px = np.empty(n, np.int32)
+    py = np.empty(n, np.int32)
+    ok = np.empty(n, np.bool_)
+    for i in range(n):
+        x = pts[i, 0]
+        y = pts[i, 1]
+        ok[i] = (pts[i, 2] >= VISIBILITY_THRESHOLD
+                 and 0.0 <= x <= 1.0 and 0.0 <= y <= 1.0)
+        px[i] = min(int(x * w), w - 1)
+        py[i] = min(int(y * h), h - 1)
+    
+    radius = thickness // 2
+    for k in range(conns.shape[0]):
+        a = conns[k, 0]
+        b = conns[k, 1]
+        if ok[a] and ok[b]:
+            _line(frame, px[a], py[a], px[b], py[b], radius, line_color)
+    for i in range(n):
+        if ok[i]:
+            _stamp(frame, px[i], py[i], thickness, point_color)
+
+def landmarks_to_array(landmark_list, use_visibility=True):
+    # (x, y, visibility) de todos los landmarks en un solo float32[N, 3];
+    # sin use_visibility se marcan todos como visibles
+    lms = landmark_list.landmark
+    if use_visibility:
+        values = (v for lm in lms for v in (lm.x, lm.y, lm.visibility))
+    else:
+        values = (v for lm in lms for v in (lm.x, lm.y, 1.0))
+    return np.fromiter(values, dtype=np.float32, count=len(lms) * 3).reshape(-1, 3)
+
+# Lecturas fallidas seguidas (~3 s) tras las que se da la cámara por perdida
+MAX_READ_FAILURES = 30
+
+def plane_view(video_frame):
+    # Vista numpy (alto, ancho, 3) sobre el plano de un VideoFrame empaquetado
+    # (rgb24/bgr24), respetando el padding de cada fila
+    plane = video_frame.planes[0]
+    return np.ndarray((video_frame.height, video_frame.width, 3), dtype=np.uint8,
+                      buffer=plane, strides=(plane.line_size, 3, 1))
+
 class VideoTransformTrack(MediaStreamTrack):
     kind = "video"
 
@@ -25,124 +120,248 @@ class VideoTransformTrack(MediaStreamTrack):
         
         # Inicializar cámara
         self.cap = cv2.VideoCapture(0)
+        # Pedir MJPEG al driver en lugar del YUYV por defecto
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
         self.cap.set(cv2.CAP_PROP_FPS, 30)
+        # Mantener solo el frame más reciente en el buffer del driver
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
         
         if not self.cap.isOpened():
             raise RuntimeError("No se pudo abrir la cámara")
         
-        # Inicializar detectores de MediaPipe
-        self.mp_drawing = mp.solutions.drawing_utils
-        self.mp_pose = mp.solutions.pose
-        self.mp_hands = mp.solutions.hands
+        # Buffer preasignado para retrieve(); el RGB se escribe directo en un
+        # VideoFrame nuevo por frame, que nunca se reutiliza: cada peer puede
+        # seguir codificándolo sin que el hilo lo pise
+        self._height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self._width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self._bgr_buf = np.empty((self._height, self._width, 3), dtype=np.uint8)
         
-        # Configurar detectores
-        self.pose = self.mp_pose.Pose(
-            min_detection_confidence=0.5,
-            min_tracking_confidence=0.5)
-            
-        self.hands = self.mp_hands.Hands(
+        # Inicializar detector de MediaPipe
+        self.mp_holistic = mp.solutions.holistic
+        
+        # Conexiones estáticas, convertidas una sola vez
+        self._pose_conns = np.array(sorted(self.mp_holistic.POSE_CONNECTIONS), dtype=np.int32)
+        self._hand_conns = np.array(sorted(self.mp_holistic.HAND_CONNECTIONS), dtype=np.int32)
+        
+        # Colores de dibujo (RGB)
+        self._pose_point_color = np.array((0, 255, 0), dtype=np.uint8)
+        self._pose_line_color = np.array((0, 0, 255), dtype=np.uint8)
+        self._hand_point_color = np.array((255, 0, 0), dtype=np.uint8)
+        self._hand_line_color = np.array((0, 255, 255), dtype=np.uint8)
+        
+        # Un solo grafo para pose y manos (con tracking entre frames); las
+        # manos se recortan a partir de la pose. model_complexity=0 carga
+        # pose_landmark_lite.tflite, el modelo más chico que trae MediaPipe
+        self.holistic = self.mp_holistic.Holistic(
+            static_image_mode=False,
+            model_complexity=0,
+            smooth_landmarks=True,
+            enable_segmentation=False,
+            refine_face_landmarks=False,
             min_detection_confidence=0.5,
             min_tracking_confidence=0.5)
         
-        # Configurar tiempo base
-        self.time_base = Fraction(1, 30)
+        # Reloj RTP de video (90 kHz), el mismo que usa aiortc internamente:
+        # así el encoder no tiene que reescalar el pts con Fraction
+        self._clock_rate = 90000
+        self.time_base = Fraction(1, self._clock_rate)
         self.pts = 0
+        self._start_time = None
         
-    def process_frame(self, frame):
-        # Convertir a RGB para MediaPipe
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        # Captura (y procesamiento) en un hilo aparte para no bloquear el
+        # event loop; solo se guarda el frame más reciente
+        self._latest = None  # último VideoFrame, pendiente para recv
+        self._frame_ready = threading.Event()
+        # Protege _latest y el evento, para que el evento nunca quede
+        # activo sin un frame pendiente
+        self._frames_lock = threading.Lock()
+        self._running = True
+        # Loop de asyncio, para terminar el track desde el hilo de captura
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.Thread(target=self._capture_loop, daemon=True)
+        self._thread.start()
         
-        # Detectar pose
-        pose_results = self.pose.process(rgb_frame)
-        if pose_results.pose_landmarks:
-            self.mp_drawing.draw_landmarks(
-                frame, 
-                pose_results.pose_landmarks,
-                self.mp_pose.POSE_CONNECTIONS,
-                landmark_drawing_spec=self.mp_drawing.DrawingSpec(color=(0,255,0), thickness=2),
-                connection_drawing_spec=self.mp_drawing.DrawingSpec(color=(255,0,0), thickness=2)
-            )
+    def process_frame(self, bgr, rgb):
+        # Convertir a RGB una sola vez en `rgb`; se dibuja sobre el mismo buffer
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=rgb)
+        
+        # Holistic recibe el frame completo: Pose ya reduce internamente y
+        # las manos se recortan de la imagen original, necesitan resolución.
+        # MediaPipe puede evitar copias si la imagen es de solo lectura
+        rgb.flags.writeable = False
+        results = self.holistic.process(rgb)
+        rgb.flags.writeable = True
+        
+        # Dibujar pose
+        if not results.pose_landmarks:
+            # Holistic obtiene las manos a partir de la pose: sin pose no hay manos
+            return rgb
+        pose_pts = landmarks_to_array(results.pose_landmarks)
+        draw_landmarks(rgb, pose_pts, self._pose_conns,
+                       self._pose_point_color, self._pose_line_color, 2)
             
-        # Detectar manos
-        hands_results = self.hands.process(rgb_frame)
-        if hands_results.multi_hand_landmarks:
-            for hand_landmarks in hands_results.multi_hand_landmarks:
-                self.mp_drawing.draw_landmarks(
-                    frame,
-                    hand_landmarks,
-                    self.mp_hands.HAND_CONNECTIONS,
-                    landmark_drawing_spec=self.mp_drawing.DrawingSpec(color=(0,0,255), thickness=2),
-                    connection_drawing_spec=self.mp_drawing.DrawingSpec(color=(255,255,0), thickness=2)
-                )
+        # Dibujar manos (sin visibility: se marcan todos como visibles)
+        for hand_landmarks in (results.left_hand_landmarks, results.right_hand_landmarks):
+            if hand_landmarks:
+                pts = landmarks_to_array(hand_landmarks, use_visibility=False)
+                draw_landmarks(rgb, pts, self._hand_conns,
+                               self._hand_point_color, self._hand_line_color, 2)
                 
-        return frame
+        return rgb
         
-    async def recv(self):
-        ret, frame = self.cap.read()
-        
-        if not ret:
-            logger.error("Error al leer frame")
-            return None
+    def _capture_loop(self):
+        try:
+            self._capture_frames()
+        except Exception:
+            logger.exception("Error en el hilo de captura")
+        finally:
+            # El hilo es el único que usa la cámara y el modelo: liberarlos al terminar
+            self.cap.release()
+            self.holistic.close()
+            # Si el hilo terminó por su cuenta (error o cámara perdida),
+            # terminar el track para que recv falle y el relay se cierre
+            if self._running:
+                self._running = False
+                self._loop.call_soon_threadsafe(self.stop)
+
+    def _capture_frames(self):
+        failures = 0
+        while self._running:
+            # grab() sin decodificar y retrieve() solo del frame que se envía
+            ret = self.cap.grab()
+            if ret:
+                ret, frame = self.cap.retrieve(self._bgr_buf)
             
-        # Procesar frame con detectores
-        processed_frame = self.process_frame(frame)
+            if not ret:
+                failures += 1
+                if failures >= MAX_READ_FAILURES:
+                    logger.error("La cámara dejó de entregar frames")
+                    return
+                logger.error("Error al leer frame")
+                time.sleep(0.1)
+                continue
+            failures = 0
             
-        # Convertir frame para WebRTC
-        frame = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2RGB)
-        video_frame = VideoFrame.from_ndarray(frame, format="rgb24")
+            # Procesar frame con detectores, escribiendo el RGB en el VideoFrame
+            video_frame = VideoFrame(self._width, self._height, "rgb24")
+            self.process_frame(frame, plane_view(video_frame))
+            self._publish(video_frame)
+
+    def _publish(self, video_frame):
+        with self._frames_lock:
+            # Un frame que recv no llegó a leer se descarta
+            self._latest = video_frame
+            self._frame_ready.set()
+
+    async def recv(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._frame_ready.wait)
+        
+        if self.readyState != "live":
+            raise MediaStreamError
+        with self._frames_lock:
+            self._frame_ready.clear()
+            video_frame = self._latest
+            self._latest = None
+        self._advance_pts()
         video_frame.pts = self.pts
         video_frame.time_base = self.time_base
-        
-        self.pts += 1
         return video_frame
 
+    def stop(self):
+        super().stop()
+        # Detener el hilo de captura y liberar a recv si está esperando
+        self._running = False
+        self._frame_ready.set()
+
+    def join(self):
+        # Esperar a que termine el hilo de captura (después de stop())
+        self._thread.join()
+
+    def _advance_pts(self):
+        # pts según el tiempo real transcurrido, para no acumular retraso
+        # cuando se descartan frames; siempre monótono creciente
+        now = time.monotonic()
+        if self._start_time is None:
+            # El primer frame marca el origen del reloj
+            self._start_time = now
+            self.pts = 0
+            return
+        elapsed = int((now - self._start_time) * self._clock_rate)
+        self.pts = max(elapsed, self.pts + 1)
+
     def __del__(self):
         if hasattr(self, 'cap') and self.cap is not None:
             self.cap.release()
-        if hasattr(self, 'pose'):
-            self.pose.close()
-        if hasattr(self, 'hands'):
-            self.hands.close()
 
 # [El resto del código de offer() y index() permanece igual]
 
+# Una sola cámara (y un solo pipeline) compartida entre todas las conexiones;
+# MediaRelay reparte sus frames a cada peer
+relay = MediaRelay()
+camera_track = None
+# Evita que dos offers simultáneos abran la cámara dos veces
+camera_lock = asyncio.Lock()
+
+async def subscribe_camera():
+    global camera_track
+    async with camera_lock:
+        if camera_track is None or camera_track.readyState != "live":
+            if camera_track is not None:
+                # Esperar (fuera del event loop) a que el hilo anterior suelte
+                # la cámara antes de reabrirla
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, camera_track.join)
+            camera_track = VideoTransformTrack()
+    # Sin buffer: cada peer recibe solo el frame más reciente
+    return relay.subscribe(camera_track, buffered=False)
+
+def stop_camera():
+    # Detiene el hilo de captura y libera la cámara; el próximo
+    # subscribe_camera() la vuelve a abrir
+    if camera_track is not None:
+        camera_track.stop()
+
 async def offer(request):
-    params = await request.json()
+    params = orjson.loads(await request.read())
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
     pc = RTCPeerConnection()
     pcs.add(pc)
     
     @pc.on("connectionstatechange")
     async def on_connectionstatechange():
-        logger.info(f"Estado de conexión WebRTC: {pc.connectionState}")
-        if pc.connectionState == "failed":
+        logger.info("Estado de conexión WebRTC: %s", pc.connectionState)
+        if pc.connectionState in ("failed", "closed"):
             await pc.close()
             pcs.discard(pc)
+            # Sin clientes no hace falta seguir capturando
+            if not pcs:
+                stop_camera()
     
     try:
-        video = VideoTransformTrack()
-        pc.addTrack(video)
+        pc.addTrack(await subscribe_camera())
         await pc.setRemoteDescription(offer)
         answer = await pc.createAnswer()
         await pc.setLocalDescription(answer)
         
         return web.Response(
             content_type="application/json",
-            text=json.dumps({
+            body=orjson.dumps({
                 "sdp": pc.localDescription.sdp,
                 "type": pc.localDescription.type
             })
         )
     except Exception as e:
-        logger.error(f"Error en el proceso de offer: {str(e)}")
+        logger.error("Error en el proceso de offer: %s", e)
+        await pc.close()
         return web.Response(status=500, text=str(e))
 
 # Crear la aplicación
 app = web.Application()
-async def index(request):
-    content = """
+# HTML estático de la página, codificado una sola vez al cargar el módulo
+INDEX_HTML = """
     <html>
     <head>
         <title>Stream de Cámara con Pose</title>
@@ -281,11 +500,34 @@ async def index(request):
     </body>
     </html>
     """
-    return web.Response(content_type="text/html", text=content)
+_INDEX_BYTES = INDEX_HTML.encode("utf-8")
+
+async def index(request):
+    return web.Response(
+        body=_INDEX_BYTES,
+        content_type="text/html",
+        charset="utf-8",
+        headers={"Cache-Control": "public, max-age=3600"}
+    )
 app.router.add_get("/", index)
 app.router.add_post("/offer", offer)
 
+async def on_shutdown(app):
+    # Cerrar las conexiones y liberar la cámara al detener el servidor
+    await asyncio.gather(*[pc.close() for pc in pcs])
+    pcs.clear()
+    stop_camera()
+
+app.on_shutdown.append(on_shutdown)
+
 if __name__ == "__main__":
+    # uvloop (si está disponible) baja el costo de cada await en el event loop
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop no disponible, usando el event loop de asyncio")
+    
     try:
         print("\n=== Servidor de streaming con detección de poses iniciado ===")
         print("Accede a http://localhost:8080 en tu navegador")
@@ -293,6 +535,3 @@ if __name__ == "__main__":
         web.run_app(app, host="0.0.0.0", port=8080, access_log=None)
     except KeyboardInterrupt:
         print("\nServidor detenido por el usuario")
-    finally:
-        for pc in pcs:
-            pc.close()